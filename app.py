@@ -1,6 +1,8 @@
 import os
+import threading
+from functools import lru_cache, wraps
 import dash
-from dash import html, dcc, Input, Output, State, callback, no_update
+from dash import html, dcc, Input, Output, State, Patch, callback, no_update
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from rag import Retriever, Generator
@@ -9,16 +11,35 @@ from scraper import WebScraper
 # Initialize components
 API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-# Initialize scraper and get data
-scraper = WebScraper()
-if not os.path.exists("bygningsreglementet_data.json"):
-    print("No local data found. Starting scraping process...")
-    scraper.scrape_all()
-data = scraper.get_data()
+def init_once(factory):
+    """lru_cache(maxsize=1) for a no-argument factory, but overlapping first calls build only once"""
+    cached = lru_cache(maxsize=1)(factory)
+    lock = threading.Lock()
 
-# Initialize retriever and generator
-retriever = Retriever(data)
-generator = Generator(API_KEY)
+    @wraps(factory)
+    def wrapper():
+        with lock:
+            return cached()
+    return wrapper
+
+@init_once
+def get_data():
+    """Load the scraped passages, scraping them first if no local data exists"""
+    scraper = WebScraper()
+    if not os.path.exists(scraper.data_file):
+        print("No local data found. Starting scraping process...")
+        scraper.scrape_all()
+    return scraper.get_data()
+
+@init_once
+def get_retriever():
+    """Build the retriever once per process, on first use"""
+    return Retriever(get_data())
+
+@init_once
+def get_generator():
+    """Create the OpenRouter answer generator once per process, on first use"""
+    return Generator(API_KEY)
 
 # Initialize Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
@@ -69,6 +90,23 @@ app.layout = dbc.Container([
     dcc.Store(id='chat-store', data=[]),
 ], fluid=True)
 
+def make_message_cards(user_message, bot_message):
+    """Create the user and bot cards for one chat turn"""
+    return [
+        dbc.Card(
+            dbc.CardBody(user_message, style={"background-color": "#f8f9fa"}),
+            className="mb-2 ml-auto",
+            style={"width": "70%", "margin-left": "30%"}
+        ),
+        dbc.Card(
+            dbc.CardBody([
+                dcc.Markdown(bot_message, style=markdown_styles)
+            ]),
+            className="mb-2",
+            style={"width": "70%"}
+        ),
+    ]
+
 @app.callback(
     [Output('chat-history', 'children'),
      Output('chat-store', 'data'),
@@ -77,60 +115,28 @@ app.layout = dbc.Container([
      Output('user-input', 'disabled'),
      Output('loading-output', 'children')],
     [Input('submit-button', 'n_clicks')],
-    [State('user-input', 'value'),
-     State('chat-store', 'data')],
+    [State('user-input', 'value')],
     prevent_initial_call=True
 )
-def update_chat(n_clicks, user_input, chat_data):
+def update_chat(n_clicks, user_input):
     if not user_input:
         return no_update, no_update, no_update, no_update, no_update, no_update
     
-    # Disable inputs while processing
-    chat_display = dash.no_update
-    if chat_data:
-        chat_display = [
-            dbc.Card(
-                dbc.CardBody(message["user"], style={"background-color": "#f8f9fa"}),
-                className="mb-2 ml-auto",
-                style={"width": "70%", "margin-left": "30%"}
-            ) if i % 2 == 0 else
-            dbc.Card(
-                dbc.CardBody([
-                    dcc.Markdown(message["bot"], style=markdown_styles)
-                ]),
-                className="mb-2",
-                style={"width": "70%"}
-            )
-            for message in chat_data
-            for i in range(2)
-        ]
-    
     # Generate response
-    response = generator.generate_answer(user_input, data, retriever)
+    response = get_generator().generate_answer(user_input, get_retriever())
     
-    # Update chat data
-    chat_data = chat_data or []
-    chat_data.append({"user": user_input, "bot": response})
+    # Append only the new turn instead of re-sending the whole history
+    chat_store = Patch()
+    chat_store.append({"user": user_input, "bot": response})
     
-    # Create chat display
-    chat_display = []
-    for message in chat_data:
-        chat_display.extend([
-            dbc.Card(
-                dbc.CardBody(message["user"], style={"background-color": "#f8f9fa"}),
-                className="mb-2 ml-auto",
-                style={"width": "70%", "margin-left": "30%"}
-            ),
-            dbc.Card(
-                dbc.CardBody([
-                    dcc.Markdown(message["bot"], style=markdown_styles)
-                ]),
-                className="mb-2",
-                style={"width": "70%"}
-            ),
-        ])
+    chat_display = Patch()
+    chat_display.extend(make_message_cards(user_input, response))
     
-    return chat_display, chat_data, "", False, False, ""
+    return chat_display, chat_store, "", False, False, ""
 
 if __name__ == '__main__':
+    # With debug on, the reloader's watcher process re-executes this module;
+    # only warm up the retriever in the process that actually serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        get_retriever()
     app.run_server(debug=True, port=8050)
@@ -1,13 +1,27 @@
 from typing import List, Dict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
-import json
+import orjson
 import os
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 class WebScraper:
+    # Only div.accordion subtrees are read by process_tekniske_bestemmelser
+    _ACCORDION_STRAINER = SoupStrainer('div', class_='accordion')
+    _RE_DOT = re.compile(r'\.(\S)')
+    # Zero-width positions that need a space: digit/letter boundaries and around §
+    _RE_SPACING = re.compile(
+        r'(?<=\d)(?=[a-zA-ZæøåÆØÅ])'
+        r'|(?<=[a-zA-ZæøåÆØÅ])(?=\d)'
+        r'|(?<=§)(?=\S)'
+        r'|(?<=\S)(?=§)'
+    )
+
     def __init__(self, force_rescrape=False):
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=2048,
@@ -17,6 +31,14 @@ class WebScraper:
         )
         self.data_file = "bygningsreglementet_data.json"
         self.force_rescrape = force_rescrape
+        self.max_workers = 8
+        self.session = requests.Session()
+        # Keep one connection per worker alive in each host's pool
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "Bygningsreglementet-Chat/1.0 (+https://github.com/MjSandberg/Bygningsreglementet_chat)"
         self.data = []
         if not force_rescrape:
             self.load_data()
@@ -25,13 +47,13 @@ class WebScraper:
         """Load data from local storage if it exists"""
         try:
             if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
+                with open(self.data_file, 'rb') as f:
+                    self.data = orjson.loads(f.read())
                 print(f"Loaded {len(self.data)} passages from {self.data_file}")
                 return
             else:
                 return False
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"Error loading data file: {e}")
             print("Will start fresh scraping")
             if os.path.exists(self.data_file):
@@ -45,8 +67,8 @@ class WebScraper:
         """Save data to local storage"""
         try:
             print(f"Saving {len(data)} passages to {self.data_file}")
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with open(self.data_file, 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
             print("Save completed successfully")
         except Exception as e:
             print(f"Error saving data: {e}")
@@ -54,29 +76,20 @@ class WebScraper:
     def fix_text(self, text: str) -> str:
         """Fix text formatting issues"""
         # Fix punctuation
-        text = re.sub(r'\.(\S)', r'. \1', text)
-        
-        # Add space between numbers and letters
-        text = re.sub(r'(\d)([a-zA-ZæøåÆØÅ])', r'\1 \2', text)
-        
-        # Add space between letters and numbers
-        text = re.sub(r'([a-zA-ZæøåÆØÅ])(\d)', r'\1 \2', text)
-        
-        # Fix spaces around section symbols
-        text = re.sub(r'§(\S)', r'§ \1', text)
-        text = re.sub(r'(\S)§', r'\1 §', text)
-        
+        text = self._RE_DOT.sub(r'. \1', text)
+
+        # Add spaces between numbers and letters, and around section symbols
+        text = self._RE_SPACING.sub(' ', text)
+
         # Remove multiple spaces
-        text = re.sub(r'\s+', ' ', text)
-        
-        return text.strip()
+        return ' '.join(text.split())
 
     def fetch_content(self, url: str) -> BeautifulSoup:
-        """Fetch content from URL"""
+        """Fetch content from URL, keeping only the accordion blocks that hold the regulation text"""
         try:
-            response = requests.get(url)
+            response = self.session.get(url, timeout=10)
             response.raise_for_status()
-            return BeautifulSoup(response.text, 'html.parser')
+            return BeautifulSoup(response.content, 'lxml', parse_only=self._ACCORDION_STRAINER)
         except requests.RequestException as e:
             print(f"Error fetching {url}: {e}")
             return None
@@ -110,40 +123,32 @@ class WebScraper:
             print(f"Using existing data with {len(self.data)} passages")
             return
 
+        # Build the full list of (section name, url) pairs to scrape
+        pages = [("Administrative", "https://bygningsreglementet.dk/Administrative-bestemmelser/Krav?Layout=ShowAll")]
+        # Tekniske-bestemmelser (02-22)
+        pages.extend(
+            (f"Section {section:02d}", f"https://bygningsreglementet.dk/Tekniske-bestemmelser/{section:02d}/Krav?Layout=ShowAll")
+            for section in range(2, 23)
+        )
+        # Bilag
+        pages.extend(
+            (bilag, f"https://bygningsreglementet.dk/Bilag/B{bilag}/Bilag_{bilag}")
+            for bilag in range(1, 7)
+        )
+
+        # Fetch pages concurrently; the work is dominated by network latency
+        print(f"Fetching {len(pages)} pages...")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            soups = list(executor.map(self.fetch_content, [url for _, url in pages]))
+
+        # Process pages serially in their original order
         all_data = []
-        
-        # Scrape Administrative-bestemmelser
-        admin_url = "https://bygningsreglementet.dk/Administrative-bestemmelser/Krav?Layout=ShowAll"
-        print(f"Processing Administrative-bestemmelser")
-        soup = self.fetch_content(admin_url)
-        if soup:
-            admin_data = self.process_tekniske_bestemmelser(soup, "Administrative")
-            print(f"Found {len(admin_data)} passages in Administrative-bestemmelser")
-            all_data.extend(admin_data)
-
-        # Scrape Tekniske-bestemmelser (02-22)
-        print("\nScraping Tekniske-bestemmelser...")
-        for section in range(2, 23):
-            section_num = f"{section:02d}"  # Format as 02, 03, etc.
-            url = f"https://bygningsreglementet.dk/Tekniske-bestemmelser/{section_num}/Krav?Layout=ShowAll"
-            print(f"Processing section {section_num}/22")
-            soup = self.fetch_content(url)
+        for (section_name, _), soup in zip(pages, soups):
             if soup:
-                section_data = self.process_tekniske_bestemmelser(soup, f"Section {section_num}")
-                print(f"Found {len(section_data)} passages in section {section_num}")
+                section_data = self.process_tekniske_bestemmelser(soup, section_name)
+                print(f"Found {len(section_data)} passages in {section_name}")
                 all_data.extend(section_data)
 
-        # Scrape Bilag
-        print("\nScraping Bilag...")
-        for bilag in range(1, 7):
-            url = f"https://bygningsreglementet.dk/Bilag/B{bilag}/Bilag_{bilag}"
-            print(f"Processing bilag {bilag}/6")
-            soup = self.fetch_content(url)
-            if soup:
-                bilag_data = self.process_tekniske_bestemmelser(soup, bilag)
-                print(f"Found {len(bilag_data)} passages in bilag {bilag}")
-                all_data.extend(bilag_data)
-
         # Save all collected data at once
         print(f"\nTotal passages collected: {len(all_data)}")
         self.save_data(all_data)